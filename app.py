@@ -4,35 +4,39 @@ Upload Excel, view apartments on a map with floor plan links.
 """
 import streamlit as st
 import pandas as pd
+import numpy as np
 import folium
-from streamlit_folium import st_folium
 from geopy.geocoders import Nominatim
 from geopy.extra.rate_limiter import RateLimiter
+from geopy.adapters import RequestsAdapter
 from st_aggrid import AgGrid, GridOptionsBuilder, DataReturnMode, GridUpdateMode
-import html as html_module
+import orjson
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import io
 import os
 import re
-import base64
 import tempfile
-import urllib.request
-import urllib.parse
-import urllib.error
-import json
+import shutil
+import time
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 st.set_page_config(page_title="Mom's Apartments Map", layout="wide")
 
 
+# https://drive.google.com/drive/folders/1ABC123... or https://drive.google.com/open?id=1ABC123
+_DRIVE_ID_RE = re.compile(r"(?:/folders/|[?&]id=)([a-zA-Z0-9_-]{20,})")
+
+
 def _extract_drive_folder_id(url_or_id: str) -> str | None:
     """Extract folder ID from Google Drive URL or return as-is if it looks like an ID."""
     s = (url_or_id or "").strip()
     if not s:
         return None
-    # Full URL: https://drive.google.com/drive/folders/1ABC123...
-    m = re.search(r"/folders/([a-zA-Z0-9_-]{20,})", s)
-    if m:
-        return m.group(1)
-    # https://drive.google.com/open?id=1ABC123
-    m = re.search(r"[?&]id=([a-zA-Z0-9_-]{20,})", s)
+    m = _DRIVE_ID_RE.search(s)
     if m:
         return m.group(1)
     # Bare ID (no slashes)
@@ -41,93 +45,205 @@ def _extract_drive_folder_id(url_or_id: str) -> str | None:
     return None
 
 
+DRIVE_FILES_URL = "https://www.googleapis.com/drive/v3/files"
+
+
+@st.cache_resource
+def _http_session() -> requests.Session:
+    """
+    One pooled keep-alive session for all Drive and ArcGIS REST calls, with a retry budget per purpose.
+    Drive calls happen while the page renders, so they get a short budget; the ArcGIS batch geocode gets the long one.
+    """
+    session = requests.Session()
+    # raise_on_status=False: after the last retry, hand back the response so the Drive/ArcGIS error message can be shown
+    # Batch geocoding: exponential backoff with jitter, capped at 10s per wait; Retry-After on 429/503 takes precedence.
+    # geocodeAddresses is idempotent, so POST is retried too (urllib3 skips POST by default).
+    batch_retry = Retry(
+        total=5,
+        backoff_factor=1,
+        backoff_jitter=0.5,
+        backoff_max=10,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=Retry.DEFAULT_ALLOWED_METHODS | {"POST"},
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    # Drive listing/downloads: at most ~3s of waiting before the error is shown; a long Retry-After isn't slept through
+    interactive_retry = Retry(
+        total=2,
+        backoff_factor=0.5,
+        backoff_max=2,
+        status_forcelist=[429, 500, 502, 503, 504],
+        respect_retry_after_header=False,
+        raise_on_status=False,
+    )
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=batch_retry))
+    session.mount("https://www.googleapis.com/", HTTPAdapter(pool_connections=2, pool_maxsize=16, max_retries=interactive_retry))
+    return session
+
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def _fetch_drive_listing(api_key: str, folder_id: str) -> dict[str, str]:
+    """List PDF/image files in a Drive folder (filename->file_id). Cached across sessions; raises on error so failures aren't cached."""
+    params = {
+        # Only PDFs and images are ever displayed, so filter server-side; 1000 is the API's max page size
+        "q": f"'{folder_id}' in parents and (mimeType='application/pdf' or mimeType contains 'image/')",
+        "key": api_key,
+        "pageSize": 1000,
+        "fields": "nextPageToken,files(id,name)",
+    }
+    files = {}
+    page_token = None
+    while True:
+        resp = _http_session().get(DRIVE_FILES_URL, params={**params, "pageToken": page_token}, timeout=15)
+        resp.raise_for_status()
+        data = orjson.loads(resp.content)  # bytes in, no str decode; faster than resp.json() on large listings
+        files.update({f["name"]: f["id"] for f in data.get("files", [])})
+        page_token = data.get("nextPageToken")
+        if not page_token:
+            break
+    return files
+
+
+DRIVE_ERROR_RETRY = 60  # seconds a failed listing is remembered for this session before it is requested again
+
+
 def _list_drive_folder(api_key: str, folder_id: str) -> tuple[dict[str, str], str | None]:
-    """List files in a Google Drive folder. Returns (filename->file_id, error_msg or None)."""
+    """
+    List PDF/image files in a Google Drive folder. Returns (filename->file_id, error_msg or None).
+    Successes are cached across sessions by _fetch_drive_listing; a failure is kept in this session only, for
+    DRIVE_ERROR_RETRY seconds, so reruns (filters, clicks, toggles) don't re-request a bad key or folder.
+    """
+    failures = st.session_state.setdefault("_drive_listing_errors", {})
+    failed = failures.get((api_key, folder_id))
+    if failed and time.time() - failed[1] < DRIVE_ERROR_RETRY:
+        return {}, failed[0]
     try:
-        q = urllib.parse.quote(f"'{folder_id}' in parents")
-        url = f"https://www.googleapis.com/drive/v3/files?q={q}&key={api_key}&fields=files(id,name)"
-        req = urllib.request.Request(url)
-        with urllib.request.urlopen(req, timeout=15) as resp:
-            data = json.loads(resp.read().decode())
-        files = {f["name"]: f["id"] for f in data.get("files", [])}
-        return files, None
-    except urllib.error.HTTPError as e:
-        body = e.read().decode() if e.fp else ""
+        files = _fetch_drive_listing(api_key, folder_id)
+    except requests.HTTPError as e:
+        body = e.response.text
         try:
-            err = json.loads(body)
+            err = orjson.loads(e.response.content)
             msg = err.get("error", {}).get("message", body)
         except Exception:
             msg = body or str(e)
-        return {}, f"Drive API error ({e.code}): {msg}"
-    except urllib.error.URLError as e:
-        return {}, f"Network error: {e.reason}"
+        msg = f"Drive API error ({e.response.status_code}): {msg}"
+    except requests.RequestException as e:
+        msg = f"Network error: {e}"
     except Exception as e:
-        return {}, str(e)
+        msg = str(e)
+    else:
+        failures.pop((api_key, folder_id), None)
+        return files, None
+    failures[(api_key, folder_id)] = (msg, time.time())
+    return {}, msg
 
 
-def _download_drive_file(api_key: str, file_id: str) -> bytes | None:
-    """Download a file from Google Drive by ID."""
+# Downloaded / uploaded floor plans live on disk; sessions only keep paths, so RAM stays bounded
+FILE_CACHE_DIR = os.path.join(tempfile.gettempdir(), "moms_apartments_files")
+DRIVE_FILE_TTL = 86400  # seconds before a downloaded Drive file is fetched again
+_COPY_CHUNK = 64 * 1024
+
+
+def _spool_to_cache(src, name: str, directory: str = FILE_CACHE_DIR) -> str:
+    """Stream a file-like object into directory/name (FILE_CACHE_DIR by default) in 64 KB chunks. Returns the path."""
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, name)
+    with tempfile.NamedTemporaryFile(dir=directory, prefix=".part-", delete=False) as out:
+        try:
+            shutil.copyfileobj(src, out, length=_COPY_CHUNK)
+        except BaseException:
+            out.close()
+            os.unlink(out.name)
+            raise
+    os.replace(out.name, path)  # atomic: a half-written file is never visible under its final name
+    return path
+
+
+def _download_drive_file(api_key: str, file_id: str) -> str | None:
+    """Download a file from Google Drive by ID into the on-disk cache (shared across sessions). Returns its path."""
+    path = os.path.join(FILE_CACHE_DIR, f"drive_{file_id}")
+    if os.path.isfile(path) and time.time() - os.path.getmtime(path) < DRIVE_FILE_TTL:
+        return path
     try:
-        url = f"https://www.googleapis.com/drive/v3/files/{file_id}?alt=media&key={api_key}"
-        req = urllib.request.Request(url)
-        with urllib.request.urlopen(req, timeout=30) as resp:
-            return resp.read()
+        params = {"alt": "media", "key": api_key}
+        with _http_session().get(f"{DRIVE_FILES_URL}/{file_id}", params=params, stream=True, timeout=30) as resp:
+            resp.raise_for_status()
+            resp.raw.decode_content = True  # undo any gzip transfer encoding while streaming
+            return _spool_to_cache(resp.raw, f"drive_{file_id}")
     except Exception:
         return None
 
 
-def _get_drive_file_bytes(api_key: str, file_id: str) -> bytes | None:
-    """Download file from Drive by ID. Cached in session to avoid repeated API calls."""
-    cache_key = f"_drive_bytes_{file_id}"
-    if cache_key in st.session_state:
-        return st.session_state[cache_key]
-    data = _download_drive_file(api_key, file_id)
-    if data:
-        st.session_state[cache_key] = data
-    return data
+DRIVE_FILE_EXTS = {".pdf": "pdf", ".jpeg": "image", ".jpg": "image"}  # in lookup priority order
+_UNIT_SUFFIX_RE = re.compile(r"^(.+)_([1-9][0-9]*)$")  # "address_2" → ("address", 2)
 
 
-def _find_drive_file_for_unit(files: dict[str, str], address: str, unit_index: int) -> tuple[str, str, str] | None:
+@st.cache_data(show_spinner=False)
+def _index_drive_files(files: dict[str, str]) -> dict[tuple[str, int], tuple[str, str, str]]:
     """
-    Find Drive file by address + unit index. Address must match column D exactly.
+    Index Drive files by (address, unit_index), built once per folder listing.
     Files: address.pdf, address.jpeg, address.jpg | address_1.pdf for 2nd unit, etc.
-    Returns (file_id, "pdf"|"image", filename) or None.
+    Values are (file_id, "pdf"|"image", filename); .pdf wins over .jpeg over .jpg.
     """
-    base = str(address).strip()  # Identical to column D
-    exts = [".pdf", ".jpeg", ".jpg"]
-    if unit_index == 0:
-        for ext in exts:
-            cand = base + ext
-            if cand in files:
-                return files[cand], "pdf" if ext == ".pdf" else "image", cand
-    else:
-        suffix = f"_{unit_index}"
-        for ext in exts:
-            cand = base + suffix + ext
-            if cand in files:
-                return files[cand], "pdf" if ext == ".pdf" else "image", cand
-    return None
+    priority = list(DRIVE_FILE_EXTS)
+    index: dict[tuple[str, int], tuple[str, str, str]] = {}
+    rank: dict[tuple[str, int], int] = {}
+    for name, file_id in files.items():
+        stem, ext = os.path.splitext(name)
+        if ext not in DRIVE_FILE_EXTS:
+            continue
+        r = priority.index(ext)
+        # "X_1.pdf" is unit 1 of address "X", but also unit 0 of an address literally named "X_1"
+        keys = [(stem, 0)]
+        m = _UNIT_SUFFIX_RE.match(stem)
+        if m:
+            keys.append((m.group(1), int(m.group(2))))
+        for key in keys:
+            if key not in index or r < rank[key]:
+                index[key] = (file_id, DRIVE_FILE_EXTS[ext], name)
+                rank[key] = r
+    return index
+
+
+def _find_drive_file_for_unit(drive_index: dict, address: str, unit_index: int) -> tuple[str, str, str] | None:
+    """
+    Find Drive file by address + unit index. Address must match column D exactly.
+    drive_index comes from _index_drive_files. Returns (file_id, "pdf"|"image", filename) or None.
+    """
+    return drive_index.get((str(address).strip(), unit_index))
 st.title("Mom's Apartments Map")
 
 
-# Geocoding: Nominatim first, ArcGIS as fallback (both free, no API key)
+# Geocoding: ArcGIS first (queried in parallel), Nominatim as fallback (both free, no API key)
 @st.cache_resource
 def get_geocoders():
-    nominatim = RateLimiter(Nominatim(user_agent="moms_apartments_map", timeout=10).geocode, min_delay_seconds=1.1)
+    # RequestsAdapter: keep-alive session per geocoder, so repeat lookups skip the TCP+TLS handshake
+    nominatim = RateLimiter(
+        Nominatim(user_agent="moms_apartments_map", timeout=10, adapter_factory=RequestsAdapter).geocode,
+        min_delay_seconds=1.1,
+    )
     from geopy.geocoders import ArcGIS
-    arcgis = RateLimiter(ArcGIS(timeout=10).geocode, min_delay_seconds=0.5)
+    arcgis_adapter = partial(RequestsAdapter, pool_maxsize=GEOCODE_WORKERS)  # one pooled connection per worker thread
+    arcgis = ArcGIS(timeout=10, adapter_factory=arcgis_adapter).geocode  # no RateLimiter: concurrency is bounded by GEOCODE_WORKERS
     return nominatim, arcgis
 
 CITY = "תל אביב"  # Tel Aviv - all addresses are here
+GEOCODE_WORKERS = 16  # parallel ArcGIS requests; Nominatim stays serial (1 req/s usage policy)
 
-def geocode_address(address: str, geocode_nominatim, geocode_arcgis):
-    """Convert address to (lat, lon). Tries Nominatim, then ArcGIS."""
+def _geocode_query(address: str) -> str:
+    """Full query for an address: append the city and country unless already present."""
     query = str(address).strip()
     if CITY not in query and "Tel Aviv" not in query.lower():
         query = f"{query}, {CITY}"
     if "Israel" not in query and "ישראל" not in query:
         query = f"{query}, Israel"
-    for geocode in [geocode_nominatim, geocode_arcgis]:
+    return query
+
+def geocode_address(address: str, *geocoders):
+    """Convert address to (lat, lon). Tries each geocoder in order."""
+    query = _geocode_query(address)
+    for geocode in geocoders:
         try:
             result = geocode(query)
             if result:
@@ -201,35 +317,238 @@ def _get_address_col(df: pd.DataFrame) -> str | None:
             return c
     return None
 
+SHEET_NAME = "דירוג"
+
+
+@st.cache_resource(show_spinner=False, max_entries=4)
+def _load_sheet(file_bytes: bytes) -> tuple[pd.DataFrame | None, str | None]:
+    """
+    Parse the apartments sheet once per file; reruns (filters, clicks, layer changes) reuse the cached result.
+    Returns (columns from the address column onward, address column), or (None, None) if there is no address column.
+    The frame is one shared instance across reruns and sessions, so it must never be mutated; copy before handing it to
+    anything that writes to its input (AgGrid does).
+    """
+    df_full = pd.read_excel(io.BytesIO(file_bytes), sheet_name=SHEET_NAME, header=0, engine="calamine")
+    address_col = _get_address_col(df_full)
+    if address_col is None:
+        return None, None
+    # Columns before the address (A–C) are never used; slice here so the copy happens once per file, not per rerun
+    return df_full.iloc[:, df_full.columns.get_loc(address_col):], address_col
+
 # Require Excel upload
 if excel_file is None:
     st.info("Please upload an Excel file.")
     st.stop()
 
-df_full = pd.read_excel(excel_file, sheet_name="דירוג", header=0)
-address_col = _get_address_col(df_full)
+df, address_col = _load_sheet(excel_file.getvalue())
 if address_col is None:
     st.error("Could not find address column (כתובת - מיקום or כתובת-מיקום).")
     st.stop()
 
-addr_idx = df_full.columns.get_loc(address_col)
-df = df_full.iloc[:, addr_idx:].copy()
 st.sidebar.success(f"Loaded {len(df)} apartments")
 
 # ---- Geocode addresses (cached—runs once per set of addresses) ----
-unique_addresses = [str(a).strip() for a in df[address_col].dropna().unique().tolist() if a and str(a).strip()]
+# dict.fromkeys: dedupe again after stripping ("א " and "א" are one query), keeping first-seen order
+unique_addresses = list(dict.fromkeys(str(a).strip() for a in df[address_col].dropna().unique().tolist() if a and str(a).strip()))
 
-@st.cache_data(ttl=86400)
-def _geocode_all(addresses: tuple) -> dict:
+class _GeocodeMiss(Exception):
+    """Raised by _geocode_found so a miss is never written to the persistent cache."""
+
+
+# Trailing ", Tel Aviv" / ", Israel" style annotations; stripped so they're re-appended in one canonical form
+_GEOCODE_SUFFIX_RE = re.compile(
+    r"(?:\s*,\s*(?:israel|ישראל|tel[\s-]*aviv(?:[\s-]*(?:yafo|jaffa))?|תל[\s-]*אביב(?:[\s-]*יפו)?))+\s*$",
+    re.IGNORECASE,
+)
+
+
+def _geocode_key(address: str) -> str:
+    """Normalized full query for an address (city/country suffixes canonicalized, whitespace collapsed); the per-address cache key."""
+    return " ".join(_geocode_query(_GEOCODE_SUFFIX_RE.sub("", str(address).strip())).split())
+
+
+@st.cache_data(persist="disk", show_spinner=False)
+def _geocode_found(query: str, _peek: bool = False, _seed: tuple | None = None) -> tuple:
+    """
+    ArcGIS first, then rate-limited Nominatim. Hits are persisted to disk and survive restarts (persisted caches have no TTL).
+    The underscore args are not part of the cache key: _peek=True only reads the cache (a miss raises, no network);
+    _seed stores an already-known hit (e.g. from the batch request) under query.
+    """
+    if _seed is not None:
+        return _seed
+    if _peek:
+        raise _GeocodeMiss(query)
     geocode_nom, geocode_arc = get_geocoders()
+    latlon = geocode_address(query, geocode_arc) or geocode_address(query, geocode_nom)
+    if latlon is None:
+        raise _GeocodeMiss(query)
+    return latlon
+
+
+@st.cache_data(ttl=86400, show_spinner=False)
+def _geocode_one(query: str):
+    """(lat, lon) or None for a _geocode_key query. Misses are cached here in memory for a day, so failures aren't retried every run."""
+    try:
+        return _geocode_found(query)
+    except _GeocodeMiss:
+        return None
+
+ARCGIS_BATCH_URL = "https://geocode.arcgis.com/arcgis/rest/services/World/GeocodeServer/geocodeAddresses"
+ARCGIS_BATCH_SIZE = 150  # the World service's suggested batch size (hard max 1000); batches are sent concurrently
+ARCGIS_BATCH_WORKERS = 4
+
+
+def _get_arcgis_key() -> str:
+    """ArcGIS API key from secrets or env. Batch geocoding needs one; without it, addresses are geocoded one by one."""
+    try:
+        s = getattr(st, "secrets", None) or {}
+        return (s.get("ARCGIS_API_KEY") or os.environ.get("ARCGIS_API_KEY") or "").strip()
+    except Exception:
+        return (os.environ.get("ARCGIS_API_KEY") or "").strip()
+
+
+def _arcgis_batch_chunk(chunk: tuple, api_key: str) -> dict:
+    """One geocodeAddresses POST. Returns {address: (lat, lon)} for its hits; raises on HTTP or service errors."""
+    records = [
+        {"attributes": {"OBJECTID": i, "SingleLine": _geocode_query(addr)}}
+        for i, addr in enumerate(chunk)
+    ]
+    resp = _http_session().post(
+        ARCGIS_BATCH_URL,
+        data={"addresses": orjson.dumps({"records": records}).decode(), "sourceCountry": "ISR", "outSR": 4326, "f": "json", "token": api_key},
+        timeout=60,
+    )
+    resp.raise_for_status()
+    data = orjson.loads(resp.content)
+    if "error" in data:  # bad/expired token comes back as HTTP 200 with an error body
+        err = data["error"]
+        raise ValueError(err.get("message", err) if isinstance(err, dict) else err)
     coords = {}
-    for addr in addresses:
-        latlon = geocode_address(addr, geocode_nom, geocode_arc)
-        coords[addr] = latlon
+    for loc in data.get("locations", []):
+        point = loc.get("location") or {}
+        x, y = point.get("x"), point.get("y")
+        if loc.get("score") and isinstance(x, (int, float)) and isinstance(y, (int, float)):
+            coords[chunk[loc["attributes"]["ResultID"]]] = (y, x)
     return coords
 
+
+def _arcgis_batch_error(e: Exception) -> str:
+    """Readable cause of a failed geocodeAddresses chunk."""
+    if isinstance(e, requests.HTTPError):
+        return f"HTTP {e.response.status_code}: {e.response.text[:200] or e}"
+    if isinstance(e, requests.RequestException):
+        return f"network error: {e}"
+    return str(e)
+
+
+def _arcgis_batch_geocode(addresses: tuple, api_key: str) -> tuple[dict, str | None]:
+    """
+    Geocode many addresses per POST via ArcGIS geocodeAddresses. Returns ({address: (lat, lon)} for hits, error_msg or None).
+    A failed chunk only loses its own addresses (the caller looks those up one by one); hits from the other chunks are kept.
+    """
+    chunks = [addresses[i:i + ARCGIS_BATCH_SIZE] for i in range(0, len(addresses), ARCGIS_BATCH_SIZE)]
+    if not chunks:
+        return {}, None
+    coords = {}
+    errors = []
+    with ThreadPoolExecutor(max_workers=min(len(chunks), ARCGIS_BATCH_WORKERS)) as executor:
+        futures = [executor.submit(_arcgis_batch_chunk, chunk, api_key) for chunk in chunks]
+        for future in futures:
+            try:
+                coords.update(future.result())
+            except (requests.RequestException, ValueError, KeyError, IndexError, TypeError) as e:
+                errors.append(_arcgis_batch_error(e))
+    if not errors:
+        return coords, None
+    causes = "; ".join(dict.fromkeys(errors))  # distinct causes, in chunk order
+    return coords, f"ArcGIS batch geocoding: {len(errors)} of {len(chunks)} batches failed ({causes})"
+
+
+class _BatchFailed(Exception):
+    """Raised by _geocode_all_cached so a result with a failed batch is never cached; carries that result."""
+
+    def __init__(self, coords: dict, error: str):
+        super().__init__(error)
+        self.coords, self.error = coords, error
+
+
+ARCGIS_BATCH_RETRY = 60  # seconds this session skips the batch request after it failed
+
+
+@st.cache_data(ttl=86400)
+def _geocode_all_cached(addresses: tuple, arcgis_key: str = "") -> dict:
+    """{address: (lat, lon) or None} in input order. Batch failures fall back to per-query lookups and raise _BatchFailed."""
+    # Keyed by normalized query, so "רוטשילד 88", "רוטשילד  88, תל אביב" and "רוטשילד 88, Israel" are one lookup and one cache entry
+    keys = {addr: _geocode_key(addr) for addr in addresses}
+    queries = list(dict.fromkeys(keys.values()))
+    by_query, batch_error = {}, None
+    if arcgis_key:
+        # Queries persisted by an earlier run skip the (credit-metered) batch request
+        todo = []
+        for q in queries:
+            try:
+                by_query[q] = _geocode_found(q, _peek=True)
+            except _GeocodeMiss:
+                todo.append(q)
+        # With an ArcGIS key, most of the rest resolve in one batch request; hits are persisted like per-query ones
+        batch, batch_error = _arcgis_batch_geocode(tuple(todo), arcgis_key)
+        for q, latlon in batch.items():
+            by_query[q] = _geocode_found(q, _seed=latlon)
+    # Concurrent per-query lookups for the rest: ArcGIS calls overlap (network-bound), Nominatim
+    # fallbacks still queue on the RateLimiter; queries seen before are cache hits
+    rest = [q for q in queries if q not in by_query]
+    with ThreadPoolExecutor(max_workers=GEOCODE_WORKERS) as executor:
+        by_query.update(zip(rest, executor.map(_geocode_one, rest)))
+    # input order (first address centers the map)
+    coords = {addr: by_query[keys[addr]] for addr in addresses}
+    if batch_error:
+        raise _BatchFailed(coords, batch_error)
+    return coords
+
+
+def _geocode_all(addresses: tuple, arcgis_key: str = "") -> tuple[dict, str | None]:
+    """
+    (_geocode_all_cached result, batch error_msg or None). A failed batch is not cached: the next try reuses persisted
+    hits and re-batches only the rest. Within ARCGIS_BATCH_RETRY of a failure, this session looks addresses up one by one.
+    """
+    failed = st.session_state.get("_arcgis_batch_error")
+    if arcgis_key and failed and time.time() - failed[1] < ARCGIS_BATCH_RETRY:
+        return _geocode_all_cached(addresses), failed[0]
+    try:
+        coords = _geocode_all_cached(addresses, arcgis_key)
+    except _BatchFailed as e:
+        st.session_state["_arcgis_batch_error"] = (e.error, time.time())
+        return e.coords, e.error
+    st.session_state.pop("_arcgis_batch_error", None)
+    return coords, None
+
+def _coord_cols(df: pd.DataFrame) -> tuple[str | None, str | None]:
+    """Optional (lat column, lon column), matched case-insensitively as Lat/Latitude and Lon/Lng/Longitude."""
+    by_name = {str(c).strip().lower(): c for c in df.columns}
+    lat_col = next((by_name[n] for n in ("lat", "latitude") if n in by_name), None)
+    lon_col = next((by_name[n] for n in ("lon", "lng", "longitude") if n in by_name), None)
+    return lat_col, lon_col
+
+
+def _sheet_coords(df: pd.DataFrame, address_col: str) -> dict:
+    """{address: (lat, lon)} from optional Lat/Lon columns, for rows that have both. These addresses skip geocoding."""
+    lat_col, lon_col = _coord_cols(df)
+    if lat_col is None or lon_col is None:
+        return {}
+    lat = pd.to_numeric(df[lat_col], errors="coerce")
+    lon = pd.to_numeric(df[lon_col], errors="coerce")
+    ok = lat.between(-90, 90) & lon.between(-180, 180) & df[address_col].notna()
+    addrs = df.loc[ok, address_col].astype(str).str.strip()
+    # First filled row wins when an address has several units
+    first = pd.DataFrame({"lat": lat[ok], "lon": lon[ok]}).groupby(addrs.to_numpy(), sort=False).first()
+    return {a: (float(la), float(lo)) for a, la, lo in first.itertuples() if a}
+
+sheet_coords = _sheet_coords(df, address_col)
 with st.spinner("Geocoding addresses (only on first load)…"):
-    coords = _geocode_all(tuple(unique_addresses))
+    coords, batch_error = _geocode_all(tuple(a for a in unique_addresses if a not in sheet_coords), _get_arcgis_key())
+coords = {a: sheet_coords.get(a) or coords.get(a) for a in unique_addresses}
+if batch_error:
+    st.sidebar.warning(f"{batch_error}. Their addresses were geocoded one by one.")
 
 # Filter to addresses we could geocode
 geocoded = {a: c for a, c in coords.items() if c is not None}
@@ -241,6 +560,10 @@ if not geocoded:
     st.error("No addresses could be geocoded. Check that addresses include city (e.g. 'Tel Aviv').")
     st.stop()
 
+# Same coordinates as one (N, 2) array, for vectorized nearest-marker lookup on map click
+geocoded_addrs = list(geocoded)
+geocoded_coords = np.array(list(geocoded.values()), dtype=np.float64)
+
 # ---- Detect column types (for AgGrid filter config) ----
 def _is_numeric(col_name: str) -> bool:
     if col_name not in df.columns:
@@ -254,27 +577,33 @@ numeric_cols = [c for c in filter_cols if _is_numeric(c)]
 st.subheader("All Apartments")
 st.caption("Click a column header to filter, or click a row to view that apartment's floor plan (same as clicking its marker on the map).")
 
-gb = GridOptionsBuilder.from_dataframe(df)
-gb.configure_default_column(filterable=True)
-gb.configure_selection("single", use_checkbox=False)
-tzion_score_col = next((c for c in df.columns if isinstance(c, str) and "ציון" in c and ("סהכ" in c or 'סה"כ' in c)), None)
-for col in df.columns:
-    opts = {}
-    if col in numeric_cols:
-        opts["filter"] = "agNumberColumnFilter"
-        opts["filterParams"] = {"buttons": ["apply", "reset"]}
-    else:
-        opts["filter"] = "agSetColumnFilter"
-        opts["filterParams"] = {"excelMode": "windows"}
-    if col == address_col:
-        opts["minWidth"] = 280
-    elif col == tzion_score_col:
-        opts["minWidth"] = 120
-    gb.configure_column(col, **opts)
-grid_opts = gb.build()
+@st.cache_data(show_spinner=False)
+def _build_grid_opts(schema: pd.DataFrame, address_col: str, numeric_cols: tuple) -> dict:
+    """AgGrid options for the sheet's columns. Depends only on column names/dtypes (pass df.iloc[:0]), so reruns reuse it."""
+    gb = GridOptionsBuilder.from_dataframe(schema)
+    gb.configure_default_column(filterable=True)
+    gb.configure_selection("single", use_checkbox=False)
+    tzion_score_col = next((c for c in schema.columns if isinstance(c, str) and "ציון" in c and ("סהכ" in c or 'סה"כ' in c)), None)
+    for col in schema.columns:
+        opts = {}
+        if col in numeric_cols:
+            opts["filter"] = "agNumberColumnFilter"
+            opts["filterParams"] = {"buttons": ["apply", "reset"]}
+        else:
+            opts["filter"] = "agSetColumnFilter"
+            opts["filterParams"] = {"excelMode": "windows"}
+        if col == address_col:
+            opts["minWidth"] = 280
+        elif col == tzion_score_col:
+            opts["minWidth"] = 120
+        gb.configure_column(col, **opts)
+    # Round-trip to plain dicts: the builder's nested defaultdicts can't be pickled into st.cache_data
+    return orjson.loads(orjson.dumps(gb.build()))
+
+grid_opts = _build_grid_opts(df.iloc[:0], address_col, tuple(numeric_cols))
 
 grid_return = AgGrid(
-    df,
+    df.copy(),  # AgGrid writes to its input (adds ::auto_unique_id::, ISO-formats dates); df is the shared cached frame
     gridOptions=grid_opts,
     data_return_mode=DataReturnMode.FILTERED,
     update_mode=GridUpdateMode.FILTERING_CHANGED | GridUpdateMode.SELECTION_CHANGED,
@@ -287,123 +616,70 @@ if filtered_df is None or filtered_df.empty:
     filtered_df = df
 
 # ---- Build map (using filtered_df from table) ----
-center = list(geocoded.values())[0]
-_tile_map = {
-    "Street": ("OpenStreetMap", None),
-    "Satellite": ("https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}", "Esri"),
-    "Terrain": ("https://{s}.tile.opentopomap.org/{z}/{x}/{y}.png", '&copy; <a href="https://opentopomap.org/">OpenTopoMap</a>'),
-    "Google Street": ("https://mt1.google.com/vt/lyrs=m&x={x}&y={y}&z={z}", "Google"),
-    "Google Satellite": ("https://mt1.google.com/vt/lyrs=s&x={x}&y={y}&z={z}", "Google"),
-}
-_layer = st.session_state.get("map_layer", "Street")
-_tiles, _attr = _tile_map.get(_layer, _tile_map["Street"])
-m = folium.Map(location=center, zoom_start=13, tiles=_tiles, attr=_attr)
+def _prices_to_m(vals: pd.Series) -> pd.Series:
+    """Format prices in millions: 6_000_000 → 6 מש״ח, 5_900_000 → 5.9 מש״ח. Below 1M (or unparsable) stays as-is. Parsed column-wise."""
+    raw = vals.astype(str)
+    num = pd.to_numeric(raw.str.replace(r"[, ]", "", regex=True), errors="coerce")
+    big = num >= 1_000_000
+    if not big.any():  # e.g. rents, or every price filtered out / empty: nothing to format (and .str needs strings)
+        return raw
+    millions = (num[big] / 1_000_000).map("{:.1f}".format).astype(str).str.rstrip("0").str.rstrip(".") + " מש״ח"
+    return raw.where(~big, millions)
+
+
+def _rows_html(df: pd.DataFrame, cols: list, bold_values: bool = False) -> pd.Series:
+    """Per-row popup table rows (<tr>…</tr>) for the non-empty cells of cols. Built column-wise, not row by row."""
+    out = pd.Series("", index=df.index, dtype=object)
+    for col in cols:
+        if col not in df.columns:
+            continue
+        vals = df[col]
+        display_name = col.rstrip(':') if isinstance(col, str) else col
+        cell = vals.astype(str)
+        if bold_values:
+            cell = "<b>" + cell + "</b>"
+        frag = f"<tr><td style='padding:2px 8px 2px 0;vertical-align:top'><b>{display_name}:</b></td><td>" + cell + "</td></tr>"
+        out = out + frag.where(vals.notna(), "")
+    return out
+
+
+def _address_rows(filtered_df, address_col, price_col, score_col, rows_main, rows_tzion) -> dict:
+    """One entry per address, built in a single groupby pass: unit count, joined price/score strings, and the per-unit popup rows."""
+    keys = filtered_df[address_col]
+    g = filtered_df.groupby(keys, sort=False)
+    agg = pd.DataFrame({
+        "n_units": g.size(),
+        "rows_main": rows_main.groupby(keys, sort=False).agg(list),
+        "rows_tzion": rows_tzion.groupby(keys, sort=False).agg(list),
+    })
+    if price_col and price_col in filtered_df.columns:
+        has_price = filtered_df[price_col].notna()
+        prices = _prices_to_m(filtered_df.loc[has_price, price_col])
+        agg["prices"] = prices.groupby(keys[has_price], sort=False).agg(", ".join).reindex(agg.index, fill_value="")
+    else:
+        agg["prices"] = ""
+    if score_col and score_col in filtered_df.columns:
+        agg["scores"] = g[score_col].agg(lambda s: ", ".join(map(str, s.dropna())))
+    else:
+        agg["scores"] = ""
+    return agg.to_dict("index")
 
-# Opaque popup + scrollable content; RTL for Hebrew; dark text; highlight for selected marker
-selected_addr = st.session_state.get("_clicked_addr") or ""
-popup_css = """
-.leaflet-popup-content-wrapper, .leaflet-popup-tip { background: white !important; opacity: 1 !important; }
-.leaflet-popup-content { margin: 12px 16px !important; max-height: 450px !important; overflow-y: auto !important; direction: rtl !important; text-align: right !important; color: #333 !important; }
-.leaflet-marker-icon.selected-marker { filter: drop-shadow(0 0 4px #0066ff) drop-shadow(0 0 8px #0066ff) !important; }
-"""
-m.get_root().header.add_child(folium.Element(f"<style>{popup_css}</style>"))
-# Script applies highlight to selected marker (add to parent .leaflet-marker-icon); retry until map ready
-highlight_script = f"""
-<script>
-(function() {{
-  var sel = {json.dumps(selected_addr)};
-  function apply() {{
-    document.querySelectorAll('[data-addr]').forEach(function(el) {{
-      var icon = el.closest('.leaflet-marker-icon');
-      if (icon) icon.classList.remove('selected-marker');
-      if (el.dataset.addr === sel) {{
-        var icon = el.closest('.leaflet-marker-icon');
-        if (icon) icon.classList.add('selected-marker');
-      }}
-    }});
-  }}
-  function run() {{ apply(); }}
-  var attempts = 0;
-  function tryApply() {{
-    apply();
-    if (document.querySelectorAll('[data-addr]').length === 0 && attempts++ < 20) setTimeout(tryApply, 100);
-  }}
-  if (document.readyState === 'loading') document.addEventListener('DOMContentLoaded', function() {{ setTimeout(tryApply, 300); }});
-  else setTimeout(tryApply, 300);
-}})();
-</script>
-"""
-m.get_root().header.add_child(folium.Element(highlight_script))
-
-# Additional tile layers
-folium.TileLayer(
-    "https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}",
-    attr="Esri",
-    name="Satellite",
-).add_to(m)
-folium.TileLayer(
-    tiles="https://{s}.tile.opentopomap.org/{z}/{x}/{y}.png",
-    attr='&copy; <a href="https://opentopomap.org/">OpenTopoMap</a>',
-    name="Terrain",
-).add_to(m)
-folium.TileLayer(
-    tiles="https://mt1.google.com/vt/lyrs=m&x={x}&y={y}&z={z}",
-    attr="Google",
-    name="Google Street",
-).add_to(m)
-folium.TileLayer(
-    tiles="https://mt1.google.com/vt/lyrs=s&x={x}&y={y}&z={z}",
-    attr="Google",
-    name="Google Satellite",
-).add_to(m)
-folium.LayerControl(position="topright").add_to(m)
-
-def _price_to_m(val):
-    """Format price in millions: 6_000_000 → 6 מש״ח, 5_900_000 → 5.9 מש״ח. Below 1M stays as-is."""
-    try:
-        s = str(val).replace(",", "").replace(" ", "")
-        num = float(s)
-        if num >= 1_000_000:
-            m = num / 1_000_000
-            fmt = f"{m:.1f}".rstrip("0").rstrip(".")
-            return f"{fmt} מש״ח"
-        return str(val)
-    except (ValueError, TypeError):
-        return str(val)
-
-
-def _build_popup_html(addr, units, drive_files, price_col, info_cols_main, info_cols_tzion):
-    """Build popup HTML for an address and its units (same as map marker popup)."""
+
+def _build_popup_html(addr, row, drive_index, price_label):
+    """Build popup HTML for an address from its _address_rows entry (same as map marker popup)."""
     popup_parts = ['<div style="color:#333">', f"<b>{addr}</b>"]
-    if price_col and price_col in units.columns:
-        prices = [_price_to_m(row[price_col]) for _, row in units.iterrows() if pd.notna(row.get(price_col))]
-        if prices:
-            price_label = price_col.rstrip(':') if isinstance(price_col, str) else "מחיר"
-            popup_parts.append(f"<div style='margin:4px 0 8px 0'><b>{price_label}</b>: {', '.join(prices)}</div>")
+    if row["prices"]:
+        popup_parts.append(f"<div style='margin:4px 0 8px 0'><b>{price_label}</b>: {row['prices']}</div>")
     popup_parts.append("<hr style='margin:8px 0'>")
-    for i, (_, row) in enumerate(units.iterrows()):
+    for i, (main_lines, tzion_lines) in enumerate(zip(row["rows_main"], row["rows_tzion"])):
         if i > 0:
             popup_parts.append("<hr style='margin:14px 0; border: none; border-top: 2px solid #333'>")
-        unit_lines = []
-        for col in info_cols_main:
-            if col in row.index and pd.notna(row[col]):
-                display_name = col.rstrip(':') if isinstance(col, str) else col
-                val = row[col]
-                unit_lines.append(f"<tr><td style='padding:2px 8px 2px 0;vertical-align:top'><b>{display_name}:</b></td><td>{val}</td></tr>")
-        unit_html = f"<table style='margin-bottom:4px'>{''.join(unit_lines)}</table>"
-        popup_parts.append(unit_html)
-        if info_cols_tzion:
-            tzion_lines = []
-            for col in info_cols_tzion:
-                if col in row.index and pd.notna(row[col]):
-                    display_name = col.rstrip(':') if isinstance(col, str) else col
-                    val = row[col]
-                    tzion_lines.append(f"<tr><td style='padding:2px 8px 2px 0;vertical-align:top'><b>{display_name}:</b></td><td><b>{val}</b></td></tr>")
-            if tzion_lines:
-                tzion_table = f"<table style='margin-top:4px'>{''.join(tzion_lines)}</table>"
-                popup_parts.append(f"<details style='margin:4px 0'><summary style='cursor:pointer; font-size:12px'>הצג ציון</summary>{tzion_table}</details>")
-        if drive_files:
-            found = _find_drive_file_for_unit(drive_files, addr, i)
+        popup_parts.append(f"<table style='margin-bottom:4px'>{main_lines}</table>")
+        if tzion_lines:
+            tzion_table = f"<table style='margin-top:4px'>{tzion_lines}</table>"
+            popup_parts.append(f"<details style='margin:4px 0'><summary style='cursor:pointer; font-size:12px'>הצג ציון</summary>{tzion_table}</details>")
+        if drive_index:
+            found = _find_drive_file_for_unit(drive_index, addr, i)
             if found:
                 fid, _, _ = found
                 view_url = f"https://drive.google.com/file/d/{fid}/view"
@@ -417,99 +693,184 @@ def _build_popup_html(addr, units, drive_files, price_col, info_cols_main, info_
     return "".join(popup_parts)
 
 
+HOME_ICON_HTML = '<div style="font-size: 28px; line-height: 1;">🏠</div>'
+CLUSTER_MIN_MARKERS = 500  # above this many addresses, markers are clustered
+
+# Opaque popup + scrollable content; RTL for Hebrew; dark text; highlight for selected marker
+POPUP_STYLE = """<style>
+    .leaflet-popup-content-wrapper, .leaflet-popup-tip { background: white !important; opacity: 1 !important; }
+    .leaflet-popup-content { margin: 12px 16px !important; max-height: 450px !important; overflow-y: auto !important; direction: rtl !important; text-align: right !important; color: #333 !important; }
+    .leaflet-marker-icon.selected-marker { filter: drop-shadow(0 0 4px #0066ff) drop-shadow(0 0 8px #0066ff) !important; }
+    </style>"""
+
+# All markers are one GeoJSON layer sharing a single DivIcon template; per-address popup/tooltip
+# HTML rides in feature properties and is bound here. The selected marker is highlighted once,
+# when Leaflet adds it to the map, instead of polling the DOM for marker elements.
+_MARKER_ON_EACH_FEATURE = folium.JsCode("""
+function(feature, layer) {
+    var props = feature.properties;
+    layer.bindPopup(props.popup, {maxWidth: 350});
+    layer.bindTooltip(props.tooltip, {sticky: true});
+    if (props.selected) {
+        layer.on('add', function() {
+            var el = layer.getElement();
+            if (el) L.DomUtil.addClass(el, 'selected-marker');
+        });
+    }
+}
+""")
+
+_tile_map = {
+    "Street": ("OpenStreetMap", None),
+    "Satellite": ("https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}", "Esri"),
+    "Terrain": ("https://{s}.tile.opentopomap.org/{z}/{x}/{y}.png", '&copy; <a href="https://opentopomap.org/">OpenTopoMap</a>'),
+    "Google Street": ("https://mt1.google.com/vt/lyrs=m&x={x}&y={y}&z={z}", "Google"),
+    "Google Satellite": ("https://mt1.google.com/vt/lyrs=s&x={x}&y={y}&z={z}", "Google"),
+}
+
+
+@st.cache_resource(show_spinner=False, max_entries=16)
+def _build_map(data_key, _filtered_df, _geocoded, layer, selected_addr, _drive_index, address_col, price_col, info_cols_main, info_cols_tzion):
+    """
+    Build the folium map: base tiles, popup CSS, one marker per address with filtered units.
+    Cached per (data_key, layer, selected marker); data_key fingerprints the filtered rows, coordinates and Drive
+    files (see _map_data_key), so the underscored frame/dicts are never hashed by Streamlit on reruns.
+    Returns (map, standalone HTML); the map is rendered once here. Both are shared; callers must not modify them.
+    """
+    center = list(_geocoded.values())[0]
+    _tiles, _attr = _tile_map.get(layer, _tile_map["Street"])
+    m = folium.Map(location=center, zoom_start=13, tiles=_tiles, attr=_attr)
+
+    m.get_root().header.add_child(folium.Element(POPUP_STYLE))
+
+    # Additional tile layers
+    folium.TileLayer(
+        "https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}",
+        attr="Esri",
+        name="Satellite",
+    ).add_to(m)
+    folium.TileLayer(
+        tiles="https://{s}.tile.opentopomap.org/{z}/{x}/{y}.png",
+        attr='&copy; <a href="https://opentopomap.org/">OpenTopoMap</a>',
+        name="Terrain",
+    ).add_to(m)
+    folium.TileLayer(
+        tiles="https://mt1.google.com/vt/lyrs=m&x={x}&y={y}&z={z}",
+        attr="Google",
+        name="Google Street",
+    ).add_to(m)
+    folium.TileLayer(
+        tiles="https://mt1.google.com/vt/lyrs=s&x={x}&y={y}&z={z}",
+        attr="Google",
+        name="Google Satellite",
+    ).add_to(m)
+    folium.LayerControl(position="topright").add_to(m)
+
+    # Score column to show in the tooltip: the total score if present, else the last ציון column
+    score_col = None
+    for c in _filtered_df.columns:
+        if isinstance(c, str) and "ציון" in c and ("סהכ" in c or 'סה"כ' in c):
+            score_col = c
+            break
+    if score_col is None:
+        tzion_cols = [c for c in _filtered_df.columns if isinstance(c, str) and "ציון" in c]
+        score_col = tzion_cols[-1] if tzion_cols else None
+    price_label = price_col.rstrip(':') if isinstance(price_col, str) else "מחיר"
+
+    # Popup rows for all filtered apartments at once, merged into address-level rows in one groupby pass
+    popup_rows_main = _rows_html(_filtered_df, info_cols_main)
+    popup_rows_tzion = _rows_html(_filtered_df, info_cols_tzion, bold_values=True)
+    addr_rows = _address_rows(_filtered_df, address_col, price_col, score_col, popup_rows_main, popup_rows_tzion)
+
+    # Only show markers for addresses that have filtered apartments: walk the filtered addresses, not every geocoded one
+    features = []
+    for addr, row in addr_rows.items():
+        latlon = _geocoded.get(addr)
+        if latlon is None:
+            continue
+        lat, lon = latlon
+
+        html = _build_popup_html(addr, row, _drive_index, price_label)
+        n_units = row["n_units"]
+        units_part = f" ({n_units} units)" if n_units > 1 else ""
+        score_str = f" | <b>סהכ ציון</b> <b>{row['scores']}</b>" if row["scores"] else ""
+        price_str = f" | <b>{price_label}</b> <b>{row['prices']}</b>" if row["prices"] else ""
+        features.append({
+            "type": "Feature",
+            "geometry": {"type": "Point", "coordinates": [float(lon), float(lat)]},
+            "properties": {
+                "selected": addr == selected_addr,
+                "popup": html,
+                "tooltip": f"{addr}{units_part}{price_str}{score_str}",
+            },
+        })
+    if features:
+        # Past a few hundred markers, let Leaflet.markercluster group them client-side so pan/zoom stays smooth
+        parent = m
+        if len(features) > CLUSTER_MIN_MARKERS:
+            from folium.plugins import MarkerCluster
+            parent = MarkerCluster(control=False).add_to(m)
+        folium.GeoJson(
+            {"type": "FeatureCollection", "features": features},
+            marker=folium.Marker(icon=folium.DivIcon(html=HOME_ICON_HTML, icon_size=(28, 28), icon_anchor=(14, 14))),
+            on_each_feature=_MARKER_ON_EACH_FEATURE,
+            control=False,
+        ).add_to(parent)
+    return m, m.get_root().render()  # same HTML m.save() writes
+
+
 # Attributes to show in popup (exclude PDF path, address—it's the popup title)
 # ציון columns shown separately in expandable section
-base_cols = [c for c in df.columns if c not in ["Floor Plan PDF", "Address", address_col] and "PDF" not in c]
+# Lat/Lon columns only feed geocoding; popups never show them
+coord_cols = [c for c in _coord_cols(df) if c is not None]
+base_cols = [c for c in df.columns if c not in ["Floor Plan PDF", "Address", address_col, *coord_cols] and "PDF" not in c]
 price_col = next((c for c in df.columns if isinstance(c, str) and ("מחיר" in c or c == "Price")), None)
 base_cols_no_price = [c for c in base_cols if c != price_col] if price_col else base_cols
 info_cols_main = [c for c in base_cols_no_price if "ציון" not in c]
 info_cols_tzion = [c for c in base_cols_no_price if "ציון" in c]
 
-def _make_icon(addr):
-    esc = html_module.escape(str(addr))
-    return folium.DivIcon(
-        html=f'<div style="font-size: 28px; line-height: 1;" data-addr="{esc}">🏠</div>',
-        icon_size=(28, 28),
-        icon_anchor=(14, 14),
-    )
-
 # Pre-load Drive file list when configured
 drive_files: dict[str, str] = {}
 drive_error: str | None = None
 if drive_configured and drive_api_key and drive_folder_id:
-    list_key = f"_drive_list_{drive_folder_id}"
-    if list_key not in st.session_state:
-        files, err = _list_drive_folder(drive_api_key, drive_folder_id)
-        st.session_state[list_key] = files
-        st.session_state[list_key + "_err"] = err
-    drive_files = st.session_state[list_key]
-    drive_error = st.session_state.get(list_key + "_err")
-
-# Only show markers for addresses that have filtered apartments
-for addr, (lat, lon) in geocoded.items():
-    units = filtered_df[filtered_df[address_col] == addr]
-    if units.empty:
-        continue
-
-    html = _build_popup_html(addr, units, drive_files or {}, price_col, info_cols_main, info_cols_tzion)
-    n_units = len(units)
-    score_col = None
-    for c in units.columns:
-        if isinstance(c, str) and "ציון" in c and ("סהכ" in c or 'סה"כ' in c):
-            score_col = c
-            break
-    if score_col is None:
-        tzion_cols = [c for c in units.columns if isinstance(c, str) and "ציון" in c]
-        score_col = tzion_cols[-1] if tzion_cols else None
-    scores = []
-    if score_col and score_col in units.columns:
-        for v in units[score_col].dropna():
-            scores.append(str(v))
-    prices_tooltip = []
-    if price_col and price_col in units.columns:
-        for v in units[price_col].dropna():
-            prices_tooltip.append(_price_to_m(v))
-    units_part = f" ({n_units} units)" if n_units > 1 else ""
-    score_str = f" | <b>סהכ ציון</b> <b>{', '.join(scores)}</b>" if scores else ""
-    price_label = (price_col.rstrip(':') if isinstance(price_col, str) else "מחיר") if price_col else "מחיר"
-    price_str = f" | <b>{price_label}</b> <b>{', '.join(prices_tooltip)}</b>" if prices_tooltip else ""
-    folium.Marker(
-        location=[lat, lon],
-        popup=folium.Popup(html, max_width=350),
-        tooltip=folium.Tooltip(f"{addr}{units_part}{price_str}{score_str}", sticky=True),
-        icon=_make_icon(addr),
-    ).add_to(m)
+    drive_files, drive_error = _list_drive_folder(drive_api_key, drive_folder_id)
+drive_index = _index_drive_files(drive_files) if drive_files else {}
+
+def _map_data_key(filtered_df, geocoded, drive_files) -> tuple:
+    """Cheap fingerprint of everything _build_map reads from data: vectorized per-row hashes plus two tuple hashes."""
+    return (
+        # Row hashes digested into 16 bytes in one C pass; row order matters (popup order)
+        hashlib.blake2b(pd.util.hash_pandas_object(filtered_df, index=False).to_numpy().tobytes(), digest_size=16).digest(),
+        tuple(map(str, filtered_df.columns)),
+        hash(tuple(geocoded.items())),
+        hash(tuple(drive_files.items())),
+    )
+
+selected_addr = st.session_state.get("_clicked_addr") or ""
+m, map_html = _build_map(
+    _map_data_key(filtered_df, geocoded, drive_files), filtered_df, geocoded,
+    st.session_state.get("map_layer", "Street"), selected_addr, drive_index,
+    address_col, price_col, info_cols_main, info_cols_tzion,
+)
 
 # ---- Render map (full width, large) ----
 map_height = 700
-map_data = st_folium(m, height=map_height, use_container_width=True, returned_objects=["last_object_clicked", "last_clicked"])
+# streamlit_folium imports folium.plugins and its components (~150 ms); deferred so the upload screen never loads them
+from streamlit_folium import st_folium
+# render=False: the cached map was already rendered by _build_map
+map_data = st_folium(m, height=map_height, use_container_width=True, returned_objects=["last_object_clicked", "last_clicked"], render=False)
 
 # Download standalone HTML (send to anyone—they open in browser, no app needed)
-with tempfile.NamedTemporaryFile(suffix=".html", delete=False) as tmp:
-    tmp.close()
-    try:
-        m.save(tmp.name)
-        with open(tmp.name, "rb") as f:
-            html_bytes = f.read()
-        st.sidebar.download_button("📥 Download HTML map", html_bytes, file_name="apartments_map.html", mime="text/html", help="Standalone file—send to anyone, they open in a browser")
-    finally:
-        os.unlink(tmp.name)
-
-def _dist(c1, c2):
-    """Simple distance between (lat,lon) points."""
-    return (c1[0] - c2[0]) ** 2 + (c1[1] - c2[1]) ** 2
+st.sidebar.download_button("📥 Download HTML map", map_html.encode("utf-8"), file_name="apartments_map.html", mime="text/html", help="Standalone file—send to anyone, they open in a browser")
 
 # Find which address was selected: from map click or table row click
 clicked_addr = None
 click_data = map_data.get("last_object_clicked") or map_data.get("last_clicked")
 if click_data and "lat" in click_data and "lng" in click_data:
     clat, clng = click_data["lat"], click_data["lng"]
-    best_addr, best_d = None, float("inf")
-    for addr, (lat, lon) in geocoded.items():
-        d = _dist((clat, clng), (lat, lon))
-        if d < best_d:
-            best_d, best_addr = d, addr
-    clicked_addr = best_addr
+    diff = geocoded_coords - np.array([clat, clng])
+    d2 = np.einsum("ij,ij->i", diff, diff)  # squared distances in one pass, no squared temporary
+    clicked_addr = geocoded_addrs[int(np.argmin(d2))]
 else:
     selected_rows = grid_return.get("selected_rows") if grid_return else None
     if selected_rows is not None:
@@ -523,48 +884,199 @@ if clicked_addr is not None:
     st.session_state["_clicked_addr"] = clicked_addr
 
 # ---- Floor plan panel (PDF loaded only when she opens "View Floor Plan") ----
-def _get_pdf_bytes(
+def _get_pdf_file(
     pdf_path: str,
     pdf_uploads: list | None,
     pdf_folder: str | None,
-    drive_folder_id: str | None,
+    drive_files: dict[str, str],
     drive_api_key: str | None,
-) -> bytes | None:
-    """Get PDF bytes from uploads, local folder, or Google Drive. Loaded on demand only."""
+) -> str | None:
+    """Get a local path to the PDF from uploads, local folder, or Google Drive (drive_files: the page's listing). Loaded on demand only."""
     filename = os.path.basename(pdf_path)
     cache_key = f"_pdf_{filename}"
-    if cache_key in st.session_state:
+    if cache_key in st.session_state and os.path.isfile(st.session_state[cache_key]):
         return st.session_state[cache_key]
 
+    path = None
     if pdf_uploads:
         for f in pdf_uploads:
             if f.name == filename:
-                data = f.read()
-                st.session_state[cache_key] = data
-                return data
+                f.seek(0)
+                # Straight into the static folder: the served file is the only on-disk copy of an upload
+                path = _spool_to_static(f, _static_name(f"upload_{f.file_id}", ".pdf"), f.size)
+                break
 
-    if pdf_folder and os.path.isdir(pdf_folder):
+    if path is None and pdf_folder and os.path.isdir(pdf_folder):
         full = os.path.join(pdf_folder, filename)
         if os.path.isfile(full):
-            with open(full, "rb") as f:
-                data = f.read()
-                st.session_state[cache_key] = data
-                return data
-
-    if drive_folder_id and drive_api_key:
-        list_key = f"_drive_list_{drive_folder_id}"
-        if list_key not in st.session_state:
-            files, _ = _list_drive_folder(drive_api_key, drive_folder_id)
-            st.session_state[list_key] = files
-        files = st.session_state[list_key]
-        file_id = files.get(filename)
+            path = full
+
+    if path is None and drive_files and drive_api_key:
+        file_id = drive_files.get(filename)
         if file_id:
-            data = _download_drive_file(drive_api_key, file_id)
-            if data:
-                st.session_state[cache_key] = data
-                return data
+            path = _download_drive_file(drive_api_key, file_id)
+
+    if path:
+        st.session_state[cache_key] = path
+    return path
+
+
+# Floor plans are served by Streamlit's static route (server.enableStaticServing) instead of base64 data URIs.
+# Everything here is publicly reachable by URL, so the folder is pruned by age and total size.
+STATIC_PDF_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "pdfs")
+STATIC_FILE_TTL = 86400  # seconds since a static file was last served before it is removed
+STATIC_DIR_MAX_BYTES = 500 * 1024 * 1024  # oldest-served files are removed beyond this
+STATIC_FILE_MAX_BYTES = 200 * 1024 * 1024  # Streamlit's static route refuses larger files
+
+
+def _static_name(source: str, ext: str) -> str:
+    """Static file name for a source path or upload id: opaque and collision-free across sessions."""
+    return hashlib.sha1(source.encode("utf-8")).hexdigest()[:16] + ext
+
+
+def _prune_static_dir(keep: str) -> None:
+    """
+    Remove static files not served within STATIC_FILE_TTL, then the oldest-served ones until under STATIC_DIR_MAX_BYTES.
+    keep (the file just written, whose URL is about to be returned) is never removed.
+    """
+    try:
+        entries = [e for e in os.scandir(STATIC_PDF_DIR) if e.is_file() and not e.name.startswith(".") and e.path != keep]
+    except OSError:
+        return
+    now = time.time()
+    stats = []
+    for e in entries:
+        try:
+            stats.append((e.stat().st_mtime, e.stat().st_size, e.path))
+        except OSError:  # removed by another session meanwhile
+            pass
+    stats.sort()  # oldest-served first
+    try:
+        total = sum(size for _, size, _ in stats) + os.path.getsize(keep)
+    except OSError:
+        total = sum(size for _, size, _ in stats)
+    for mtime, size, path in stats:
+        if now - mtime < STATIC_FILE_TTL and total <= STATIC_DIR_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+
+
+def _spool_to_static(src, name: str, size: int) -> str:
+    """
+    Atomically write a file-like object of size bytes to STATIC_PDF_DIR/name (see _spool_to_cache), then prune the folder.
+    Raises ValueError, before writing anything, if the file is too large to be served.
+    """
+    if size > STATIC_FILE_MAX_BYTES:
+        raise ValueError(f"file is {size / 2**20:.0f} MB; only files up to {STATIC_FILE_MAX_BYTES // 2**20} MB can be shown here")
+    path = _spool_to_cache(src, name, STATIC_PDF_DIR)
+    _prune_static_dir(keep=path)
+    return path
+
+
+def _static_file_url(path: str, ext: str = ".pdf") -> str:
+    """
+    Return the iframe URL for a floor-plan file, copying it into the static folder first (once per file version).
+    Raises ValueError for files too large to serve (see _spool_to_static).
+    """
+    if os.path.dirname(path) == STATIC_PDF_DIR:  # uploads are spooled here directly
+        dest = path
+    else:
+        # Name by source path so same-named files from different sources never collide
+        dest = os.path.join(STATIC_PDF_DIR, _static_name(path, ext))
+        if not (os.path.isfile(dest) and os.path.getmtime(dest) >= os.path.getmtime(path)):
+            with open(path, "rb") as src:
+                _spool_to_static(src, os.path.basename(dest), os.fstat(src.fileno()).st_size)
+    try:
+        os.utime(dest)  # mtime = last served, so pruning keeps files in use
+    except OSError:
+        pass
+    return f"app/static/pdfs/{os.path.basename(dest)}"
+
+
+@st.fragment
+def _floor_plan_panel(clicked_addr, units_at_addr, pdf_col):
+    """Floor plans for the clicked address. A fragment, so loading a plan doesn't rerun the table and map."""
+    st.subheader("Floor plans")
+    any_found = False
+    unit_files = []
+    # Only the PDF column is read per unit; a plain list avoids building a Series per row
+    has_pdf_col = bool(pdf_col) and pdf_col in units_at_addr.columns
+    pdf_values = units_at_addr[pdf_col].tolist() if has_pdf_col else [None] * len(units_at_addr)
+    for i, pdf_value in enumerate(pdf_values):
+        pdf_path = None
+        drive_file_id = None
+        drive_file_type = None
+        display_filename = None
+        if drive_configured and drive_index:
+            found = _find_drive_file_for_unit(drive_index, clicked_addr, i)
+            if found:
+                drive_file_id, drive_file_type, display_filename = found
+                any_found = True
+        elif has_pdf_col and pd.notna(pdf_value):
+            pdf_path = str(pdf_value)
+            display_filename = os.path.basename(pdf_path)
+            any_found = True
+        if drive_file_id or pdf_path:
+            unit_files.append((drive_file_id, drive_file_type, pdf_path, display_filename))
+
+    def _render_floor_plan(drive_file_id, drive_file_type, pdf_path, display_filename):
+        if display_filename:
+            st.caption(f"**{display_filename}**")
+        if drive_file_id and drive_api_key:
+            # Fetch via Drive API and display inline (Google blocks iframe embed of preview URL)
+            path = _download_drive_file(drive_api_key, drive_file_id)
+            if path:
+                # Served by URL like local files: the browser fetches it once, nothing is inlined into the page
+                ext, mime = (".pdf", "application/pdf") if drive_file_type == "pdf" else (".jpg", "image/jpeg")
+                try:
+                    src = _static_file_url(path, ext)
+                    st.markdown(f'<iframe src="{src}" width="100%" height="500" type="{mime}"></iframe>', unsafe_allow_html=True)
+                except ValueError as e:
+                    st.caption(f"Could not display file inline: {e}")
+            else:
+                st.caption("Could not load file from Drive. Ensure the file is shared (Anyone with the link).")
+            view_url = f"https://drive.google.com/file/d/{drive_file_id}/view"
+            st.markdown(f'[View in new tab]({view_url})')
+        elif pdf_path:
+            try:
+                pdf_file = _get_pdf_file(pdf_path, pdf_uploads or [], pdf_folder, drive_files, drive_api_key)
+                src = _static_file_url(pdf_file) if pdf_file else None
+            except Exception as e:
+                st.caption(f"Could not display PDF: {e}")
+            else:
+                if src:
+                    st.markdown(f'<iframe src="{src}" width="100%" height="500" type="application/pdf"></iframe>', unsafe_allow_html=True)
+                else:
+                    st.caption(f"PDF not found: `{os.path.basename(pdf_path)}`")
+
+    if unit_files:
+        if len(unit_files) == 1:
+            fid, ftype, pp, fn = unit_files[0]
+            _render_floor_plan(fid, ftype, pp, fn)
+        else:
+            for i, (fid, ftype, pp, fn) in enumerate(unit_files):
+                with st.expander(f"⊕ {clicked_addr} {i+1}", expanded=False):
+                    # Fetched only when asked for; toggling reruns just this fragment
+                    if st.toggle("Show floor plan", key=f"_show_plan_{clicked_addr}_{i}"):
+                        _render_floor_plan(fid, ftype, pp, fn)
+
+    if not any_found:
+        st.caption("No floor plans found for this address.")
+        if drive_configured:
+            if drive_error:
+                st.error(f"Google Drive: {drive_error}")
+            elif not drive_files:
+                st.warning("Google Drive folder is empty. Add PDF/JPEG files (named as address.pdf, address_1.pdf, etc.).")
+            else:
+                expected = f"`{clicked_addr}.pdf`" if len(units_at_addr) == 1 else f"`{clicked_addr}.pdf` / `{clicked_addr}_1.pdf`"
+                st.caption(f"Expected file names in Google Drive (must match column D exactly): {expected}")
+        else:
+            st.caption("Add a PDF column to your Excel, or configure Google Drive secrets.")
 
-    return None
 
 if clicked_addr:
     units_at_addr = filtered_df[filtered_df[address_col] == clicked_addr]
@@ -579,71 +1091,6 @@ if clicked_addr:
         has_source = bool(pdf_col)
 
     if has_source:
-        st.subheader("Floor plans")
-        any_found = False
-        unit_files = []
-        for i, (_, row) in enumerate(units_at_addr.iterrows()):
-            pdf_path = None
-            drive_file_id = None
-            drive_file_type = None
-            display_filename = None
-            if drive_configured and drive_files:
-                found = _find_drive_file_for_unit(drive_files, clicked_addr, i)
-                if found:
-                    drive_file_id, drive_file_type, display_filename = found
-                    any_found = True
-            elif pdf_col and pdf_col in row.index and pd.notna(row[pdf_col]):
-                pdf_path = str(row[pdf_col])
-                display_filename = os.path.basename(pdf_path)
-                any_found = True
-            if drive_file_id or pdf_path:
-                unit_files.append((drive_file_id, drive_file_type, pdf_path, display_filename))
-
-        def _render_floor_plan(drive_file_id, drive_file_type, pdf_path, display_filename):
-            if display_filename:
-                st.caption(f"**{display_filename}**")
-            if drive_file_id and drive_api_key:
-                # Fetch via Drive API and display inline (Google blocks iframe embed of preview URL)
-                data = _get_drive_file_bytes(drive_api_key, drive_file_id)
-                if data:
-                    b64 = base64.b64encode(data).decode()
-                    mime = "application/pdf" if drive_file_type == "pdf" else "image/jpeg"
-                    st.markdown(f'<iframe src="data:{mime};base64,{b64}" width="100%" height="500" type="{mime}"></iframe>', unsafe_allow_html=True)
-                else:
-                    st.caption("Could not load file from Drive. Ensure the file is shared (Anyone with the link).")
-                view_url = f"https://drive.google.com/file/d/{drive_file_id}/view"
-                st.markdown(f'[View in new tab]({view_url})')
-            elif pdf_path:
-                pdf_bytes = _get_pdf_bytes(pdf_path, pdf_uploads or [], pdf_folder, drive_folder_id, drive_api_key)
-                if pdf_bytes:
-                    try:
-                        b64 = base64.b64encode(pdf_bytes).decode()
-                        st.markdown(f'<iframe src="data:application/pdf;base64,{b64}" width="100%" height="500" type="application/pdf"></iframe>', unsafe_allow_html=True)
-                    except Exception as e:
-                        st.caption(f"Could not display PDF: {e}")
-                else:
-                    st.caption(f"PDF not found: `{os.path.basename(pdf_path)}`")
-
-        if unit_files:
-            if len(unit_files) == 1:
-                fid, ftype, pp, fn = unit_files[0]
-                _render_floor_plan(fid, ftype, pp, fn)
-            else:
-                for i, (fid, ftype, pp, fn) in enumerate(unit_files):
-                    with st.expander(f"⊕ {clicked_addr} {i+1}", expanded=False):
-                        _render_floor_plan(fid, ftype, pp, fn)
-
-        if has_source and not any_found:
-            st.caption("No floor plans found for this address.")
-            if drive_configured:
-                if drive_error:
-                    st.error(f"Google Drive: {drive_error}")
-                elif not drive_files:
-                    st.warning("Google Drive folder is empty. Add PDF/JPEG files (named as address.pdf, address_1.pdf, etc.).")
-                else:
-                    expected = f"`{clicked_addr}.pdf`" if len(units_at_addr) == 1 else f"`{clicked_addr}.pdf` / `{clicked_addr}_1.pdf`"
-                    st.caption(f"Expected file names in Google Drive (must match column D exactly): {expected}")
-            else:
-                st.caption("Add a PDF column to your Excel, or configure Google Drive secrets.")
+        _floor_plan_panel(clicked_addr, units_at_addr, pdf_col)
 
 # Table is the AgGrid above; filtered_df drives map and floor plans
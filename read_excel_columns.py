@@ -17,12 +17,11 @@ def read_excel_from_column_d(filepath: str) -> pd.DataFrame:
     df = pd.read_excel(
         filepath,
         sheet_name=SHEET_NAME,
-        usecols="D:ZZ",  # columns D through ZZ (skip A, B, C)
         header=0,
-        engine="openpyxl",
+        engine="calamine",
         dtype=str,  # preserve Hebrew text, avoid numeric coercion
     )
-    return df
+    return df.iloc[:, 3:]  # columns D onwards (skip A, B, C); a fixed "D:ZZ" range errors on narrower sheets
 
 
 def main():
@@ -36,7 +35,7 @@ def main():
     print(f"Sheet: {SHEET_NAME}")
 
     # Debug: list available sheets
-    xl = pd.ExcelFile(filepath)
+    xl = pd.ExcelFile(filepath, engine="calamine")
     print(f"Available sheets: {xl.sheet_names}")
 
     try:
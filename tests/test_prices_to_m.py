@@ -0,0 +1,39 @@
+"""
+Regression checks for app._prices_to_m.
+app.py is a Streamlit script (importing it runs the app), so the helper is compiled on its own from the source.
+Run: python -m pytest tests
+"""
+import ast
+import os
+
+import numpy as np
+import pandas as pd
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app.py")
+
+
+def _load_helper(name: str):
+    tree = ast.parse(open(APP_PATH, encoding="utf-8").read())
+    node = next(n for n in tree.body if isinstance(n, ast.FunctionDef) and n.name == name)
+    ns = {"pd": pd}
+    exec(compile(ast.Module(body=[node], type_ignores=[]), APP_PATH, "exec"), ns)
+    return ns[name]
+
+
+_prices_to_m = _load_helper("_prices_to_m")
+
+
+def test_all_below_million_stay_as_is():
+    out = _prices_to_m(pd.Series([4800, 6500]))
+    assert out.tolist() == ["4800", "6500"]
+
+
+def test_all_nan_and_empty():
+    out = _prices_to_m(pd.Series([np.nan, np.nan]))
+    assert len(out) == 2 and not out.str.contains("מש״ח").fillna(False).any()
+    assert _prices_to_m(pd.Series([], dtype=float)).tolist() == []
+
+
+def test_millions_formatted():
+    out = _prices_to_m(pd.Series([6_000_000, 5_900_000, "2,400,000", 7000]))
+    assert out.tolist() == ["6 מש״ח", "5.9 מש״ח", "2.4 מש״ח", "7000"]